@@ -7,28 +7,44 @@ mTLS Certificate Automation
 
 This script automates the generation of:
   • A single self‑signed Root CA for signing both client and server certificates
-  • Per‑team client keys, CSRs, and signed client certs
-  • Per‑team server keys, CSRs, and signed server certs
+  • Per‑team client keys and signed client certs
+  • Per‑team server keys and signed server certs
   • Per‑team zip packages containing the required credentials
 
 Usage:
   1. Customize the constants below (directories, key sizes, validity days, DN fields, extfile path).
   2. Populate the TEAMS dict with your team identifiers and their `commonName` (URL).
   3. Run: python3 ca.py
+     Existing keys and certs are reused; pass `--force` to regenerate everything.
   4. Find all output under `certs/` and zipped bundles under `certs/zips/`
 
 Requirements:
-  • OpenSSL installed and on your PATH
-  • Python 3.7+ (for typing)
+  • Python 3.7+ with the `cryptography` package (both provided by `flake.nix`)
 """
 
-import subprocess
+import argparse
+import configparser
+import ipaddress
+import logging
+import os
+import shutil
+import sys
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache, partial
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
+from cryptography.x509.oid import ExtendedKeyUsageOID, NameOID
 
 # ─── Global Configuration ────────────────────────────────────────────────────
 
+KEY_ALGO: str = "ec"  # "ec" (much faster to generate) or "rsa"
+EC_CURVE: ec.EllipticCurve = ec.SECP256R1()  # Curve for each EC key (P-256)
 KEY_SIZE: int = 2048  # Bits for each RSA key
 DAYS_VALID: int = 1000  # Validity of all certs in days
 
@@ -39,8 +55,18 @@ CLIENT_DIR: Path = BASE_DIR / "provider-certs"
 SERVER_DIR: Path = BASE_DIR / "server-certs"
 ZIPS_DIR: Path = BASE_DIR / "zips"
 
-# Optional OpenSSL extension file for server certs (set to None to skip)
+# Reuse one client key and one server key for every team (only the certs stay per-team).
+# Saves all but two key generations, but a leak of any team's bundle exposes every
+# team's private keys, so only enable this for throwaway test environments.
+# After turning it back off, team keys still identical to shared-*.key are regenerated
+# automatically; if those files were deleted in the meantime, run with --force instead.
+SHARED_KEYS: bool = False
+SHARED_CLIENT_KEY: Path = BASE_DIR / "shared-client.key"
+SHARED_SERVER_KEY: Path = BASE_DIR / "shared-server.key"
+
+# Optional OpenSSL-style extension file for server certs (set to None to skip)
 EXTFILE: Optional[Path] = Path("bbdgradproject.ext")
+EXTFILE_VALID: Optional[Path] = EXTFILE if (EXTFILE and EXTFILE.exists()) else None  # checked once, not per sign
 
 # DN fields common to everyone
 DN_COMMON: Dict[str, str] = {
@@ -50,6 +76,15 @@ DN_COMMON: Dict[str, str] = {
     "O":  "Miniconomy",
 }
 
+DN_OIDS: Dict[str, x509.ObjectIdentifier] = {
+    "C":  NameOID.COUNTRY_NAME,
+    "ST": NameOID.STATE_OR_PROVINCE_NAME,
+    "L":  NameOID.LOCALITY_NAME,
+    "O":  NameOID.ORGANIZATION_NAME,
+}
+
+DN_PREFIX: List[x509.NameAttribute] = [x509.NameAttribute(DN_OIDS[k], v) for k, v in DN_COMMON.items()]
+
 # Per-team configuration
 TEAMS: Dict[str, Dict[str, str]] = {
     "electronics-supplier": { "commonName": "electronics-supplier-api.projects.bbdgrad.com" },
@@ -69,41 +104,169 @@ TEAMS: Dict[str, Dict[str, str]] = {
     "recycler":             { "commonName": "recycler-api.projects.bbdgrad.com" },
 }
 
-# ─── Helper Functions ────────────────────────────────────────────────────────
-
-def run_cmd(cmd: List[str]) -> None:
-    print(f"→ {' '.join(cmd)}")
-    subprocess.run(cmd, check=True)
+PrivateKey = Union[ec.EllipticCurvePrivateKey, rsa.RSAPrivateKey]
+Extensions = Sequence[Tuple[x509.ExtensionType, bool]]  # (extension, critical)
 
+# Each key and cert written is logged at DEBUG, progress at INFO; `--quiet` hides the former
+logger = logging.getLogger("ca")
 
-def make_dir(path: Path) -> None:
-    path.mkdir(parents=True, exist_ok=True)
+# ─── Helper Functions ────────────────────────────────────────────────────────
 
-def format_subj(dn: Dict[str, str], ou: Optional[str] = None, cn: Optional[str] = None) -> str:
-    parts = [f"/{k}={v}" for k, v in dn.items()]
+def format_subj(ou: Optional[str] = None, cn: Optional[str] = None) -> x509.Name:
+    attrs = list(DN_PREFIX)
     if ou:
-        parts.append(f"/OU={ou}")
+        attrs.append(x509.NameAttribute(NameOID.ORGANIZATIONAL_UNIT_NAME, ou))
     if cn:
-        parts.append(f"/CN={cn}")
-    return "".join(parts)
-
-def generate_private_key(path: Path, size: int = KEY_SIZE) -> None:
-    run_cmd(["openssl", "genrsa", "-out", str(path), str(size)])
-
-def create_self_signed_ca(key: Path, crt: Path, subj: str, days: int = DAYS_VALID) -> None:
-    run_cmd(["openssl", "req", "-new", "-x509", "-nodes", "-days", str(days), "-key", str(key), "-out", str(crt), "-subj", subj])
+        attrs.append(x509.NameAttribute(NameOID.COMMON_NAME, cn))
+    return x509.Name(attrs)
+
+def write_pem(path: Path, data: bytes, private: bool = False) -> None:
+    # Private keys are created owner-only, like openssl does
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600 if private else 0o644)
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+
+def generate_private_key(path: Path, size: int = KEY_SIZE) -> PrivateKey:
+    logger.debug("→ generating %s key %s", KEY_ALGO, path)
+    if KEY_ALGO == "ec":
+        key = ec.generate_private_key(EC_CURVE)
+    else:
+        key = rsa.generate_private_key(public_exponent=65537, key_size=size)
+    write_pem(path, key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                      serialization.NoEncryption()), private=True)
+    return key
+
+def load_private_key(path: Path) -> PrivateKey:
+    return serialization.load_pem_private_key(path.read_bytes(), password=None)
+
+@lru_cache(maxsize=None)
+def load_ca(ca_crt: Path, ca_key: Path) -> Tuple[x509.Certificate, PrivateKey]:
+    return x509.load_pem_x509_certificate(ca_crt.read_bytes()), load_private_key(ca_key)
+
+KEY_USAGES: Dict[str, str] = {
+    "digitalSignature": "digital_signature", "nonRepudiation": "content_commitment",
+    "keyEncipherment": "key_encipherment", "dataEncipherment": "data_encipherment",
+    "keyAgreement": "key_agreement", "keyCertSign": "key_cert_sign", "cRLSign": "crl_sign",
+    "encipherOnly": "encipher_only", "decipherOnly": "decipher_only",
+}
 
-def create_csr(key: Path, csr: Path, subj: str) -> None:
-    run_cmd(["openssl", "req", "-new", "-key", str(key), "-out", str(csr), "-subj", subj])
+EXTENDED_KEY_USAGES: Dict[str, x509.ObjectIdentifier] = {
+    "serverAuth": ExtendedKeyUsageOID.SERVER_AUTH, "clientAuth": ExtendedKeyUsageOID.CLIENT_AUTH,
+    "codeSigning": ExtendedKeyUsageOID.CODE_SIGNING, "emailProtection": ExtendedKeyUsageOID.EMAIL_PROTECTION,
+    "timeStamping": ExtendedKeyUsageOID.TIME_STAMPING, "OCSPSigning": ExtendedKeyUsageOID.OCSP_SIGNING,
+}
 
-def sign_csr(csr: Path, ca_crt: Path, ca_key: Path, out_crt: Path, serial: int, days: int = DAYS_VALID, extfile: Optional[Path] = None) -> None:
-    cmd = ["openssl", "x509", "-req", "-in", str(csr), "-days", str(days), "-CA", str(ca_crt), "-CAkey", str(ca_key), "-set_serial", f"{serial:02d}", "-out", str(out_crt)]
-    if extfile and extfile.exists():
-        cmd += ["-extfile", str(extfile)]
-    run_cmd(cmd)
+def parse_general_name(kind: str, value: str) -> x509.GeneralName:
+    if kind == "DNS":
+        return x509.DNSName(value)
+    if kind == "IP":
+        return x509.IPAddress(ipaddress.ip_address(value))
+    if kind == "email":
+        return x509.RFC822Name(value)
+    if kind == "URI":
+        return x509.UniformResourceIdentifier(value)
+    raise ValueError(f"unsupported subjectAltName type {kind!r}")
+
+def split_pair(path: Path, item: str) -> Tuple[str, str]:
+    # `TYPE:value` items, e.g. `DNS:example.com` or `CA:FALSE`
+    key, sep, value = item.partition(":")
+    if not sep:
+        raise ValueError(f"{path}: expected TYPE:value, got {item!r}")
+    return key, value
+
+@lru_cache(maxsize=None)
+def load_extensions(path: Path) -> Extensions:
+    # Understands the subset of `openssl x509 -extfile` syntax used for server certs. Key
+    # identifiers are always added by build_cert, so those lines are accepted and skipped.
+    config = configparser.ConfigParser(interpolation=None, inline_comment_prefixes=("#", ";"))
+    config.optionxform = str  # keep `DNS.1`, `subjectAltName`, ... case-sensitive
+    config.read_string("[extensions]\n" + path.read_text(), source=str(path))
+
+    extensions = []
+    for name, value in config["extensions"].items():
+        critical = value.startswith("critical,")
+        items = [v.strip() for v in value.split(",")][1 if critical else 0:]
+        if name == "subjectAltName":
+            if len(items) == 1 and items[0].startswith("@"):
+                entries = [(k.split(".")[0], v) for k, v in config[items[0][1:]].items()]
+            else:
+                entries = [split_pair(path, item) for item in items]
+            ext = x509.SubjectAlternativeName([parse_general_name(k, v) for k, v in entries])
+        elif name == "basicConstraints":
+            opts = dict(split_pair(path, item) for item in items)
+            pathlen = opts.get("pathlen")
+            ext = x509.BasicConstraints(ca=opts.get("CA", "FALSE").upper() == "TRUE",
+                                        path_length=int(pathlen) if pathlen is not None else None)
+        elif name == "keyUsage":
+            flags = dict.fromkeys(KEY_USAGES.values(), False)
+            flags.update((KEY_USAGES[item], True) for item in items)
+            ext = x509.KeyUsage(**flags)
+        elif name == "extendedKeyUsage":
+            ext = x509.ExtendedKeyUsage([EXTENDED_KEY_USAGES[item] for item in items])
+        elif name in ("subjectKeyIdentifier", "authorityKeyIdentifier"):
+            continue
+        else:
+            raise ValueError(f"{path}: unsupported extension {name!r}")
+        extensions.append((ext, critical))
+    return tuple(extensions)
+
+def build_cert(subj: x509.Name, public_key, issuer: x509.Name, issuer_key: PrivateKey, serial: int,
+               days: int = DAYS_VALID, extensions: Extensions = ()) -> bytes:
+    now = datetime.now(timezone.utc)
+    builder = (
+        x509.CertificateBuilder()
+        .subject_name(subj)
+        .issuer_name(issuer)
+        .public_key(public_key)
+        .serial_number(serial)
+        .not_valid_before(now)
+        .not_valid_after(now + timedelta(days=days))
+        .add_extension(x509.SubjectKeyIdentifier.from_public_key(public_key), critical=False)
+        .add_extension(x509.AuthorityKeyIdentifier.from_issuer_public_key(issuer_key.public_key()), critical=False)
+    )
+    for ext, critical in extensions:
+        builder = builder.add_extension(ext, critical=critical)
+    return builder.sign(issuer_key, hashes.SHA256()).public_bytes(serialization.Encoding.PEM)
+
+def create_self_signed_ca(key: Path, crt: Path, subj: x509.Name, days: int = DAYS_VALID, new_key: bool = False) -> None:
+    ca_key = generate_private_key(key) if new_key else load_private_key(key)
+    logger.debug("→ self-signing %s", crt)
+    write_pem(crt, build_cert(subj, ca_key.public_key(), subj, ca_key, x509.random_serial_number(), days,
+                              extensions=[(x509.BasicConstraints(ca=True, path_length=None), True)]))
+
+def create_and_sign(key: Path, ca_crt: Path, ca_key: Path, out_crt: Path, subj: x509.Name, serial: int,
+                    days: int = DAYS_VALID, extensions: Extensions = (), new_key: bool = False) -> None:
+    # Certs are built straight from the key, so there is no CSR to write or parse
+    private_key = generate_private_key(key) if new_key else load_private_key(key)
+    issuer_crt, issuer_key = load_ca(ca_crt, ca_key)
+    logger.debug("→ signing %s", out_crt)
+    write_pem(out_crt, build_cert(subj, private_key.public_key(), issuer_crt.subject, issuer_key, serial, days, extensions))
+
+def is_current(path: Path, source: Path) -> bool:
+    # Outputs only need regenerating if missing or older than what they were derived from
+    return path.exists() and path.stat().st_mtime > source.stat().st_mtime
+
+def issue_cert(key: Path, crt: Path, subj: x509.Name, serial: int, force: bool = False,
+               shared_key: Optional[Path] = None, use_shared_key: bool = False,
+               extensions: Extensions = ()) -> bool:
+    new_key = force or not key.exists()
+    # Whether a team key is shared is decided by its contents, so toggling SHARED_KEYS
+    # either way brings existing keys in line on the next run
+    is_shared = (not new_key and shared_key is not None and shared_key.exists()
+                 and key.read_bytes() == shared_key.read_bytes())
+    if is_shared and not use_shared_key:
+        logger.warning("%s is a copy of %s but SHARED_KEYS is off; generating a new key", key, shared_key)
+        new_key = True
+    stale = new_key or not is_current(crt, ROOT_CA_KEY)
+    if use_shared_key and (new_key or not is_shared):
+        shutil.copy(shared_key, key)
+        new_key, stale = False, True
+    if not stale:
+        return False
+    create_and_sign(key, ROOT_CA_CRT, ROOT_CA_KEY, crt, subj, serial, extensions=extensions, new_key=new_key)
+    return True
 
 def create_zips() -> None:
-    make_dir(ZIPS_DIR)
     readme = """# mTLS Certificate Bundle
 
 This archive includes all credentials required for mutual TLS:
@@ -115,59 +278,84 @@ This archive includes all credentials required for mutual TLS:
 - root-ca.crt          :: Shared root certificate used to validate all other teams' certs
 """
 
-    for team in TEAMS:
+    # Every bundle ships the same root cert and README template, so prepare the bytes once up front
+    readme_tmpl = readme.encode("utf-8")
+    root_ca = ROOT_CA_CRT.read_bytes()
+
+    def zip_one(team: str) -> None:
         zip_path = ZIPS_DIR / f"{team}.zip"
-        with zipfile.ZipFile(zip_path, "w", compression=zipfile.ZIP_DEFLATED) as zipf:
+        with zipfile.ZipFile(zip_path, "w", compression=zipfile.ZIP_STORED) as zipf:
             zipf.write(CLIENT_DIR / f"{team}-client.key", arcname=f"{team}-client.key")
             zipf.write(CLIENT_DIR / f"{team}-client.crt", arcname=f"{team}-client.crt")
             zipf.write(SERVER_DIR / f"{team}-server.key", arcname=f"{team}-server.key")
             zipf.write(SERVER_DIR / f"{team}-server.crt", arcname=f"{team}-server.crt")
-            zipf.write(ROOT_CA_CRT, arcname="root-ca.crt")
-            zipf.writestr("README.md", readme.replace("<team>", team))
-        print(f"✅ Created: {zip_path}")
+            zipf.writestr("root-ca.crt", root_ca)
+            zipf.writestr("README.md", readme_tmpl.replace(b"<team>", team.encode("utf-8")))
+        logger.info("✅ Created: %s", zip_path)
+
+    # PEM is base64 and barely compresses, so entries are stored as-is and the
+    # threads only overlap the file reads and writes
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+        list(ex.map(zip_one, TEAMS))
 
 # ─── Main Execution ───
 
-def main() -> None:
-    make_dir(BASE_DIR)
-    make_dir(CLIENT_DIR)
-    make_dir(SERVER_DIR)
+def generate_team(team: str, cfg: Dict[str, str], idx: int, force: bool = False) -> None:
+    logger.info("----- Generating certs for %s -----", team)
+    # Client and server certs carry the same subject
+    subj = format_subj(ou=team, cn=cfg["commonName"])
 
-    # Root CA generation
-    if not ROOT_CA_KEY.exists():
-        generate_private_key(ROOT_CA_KEY)
-        subj = format_subj(DN_COMMON, ou="RootCA", cn="RootCA")
-        create_self_signed_ca(ROOT_CA_KEY, ROOT_CA_CRT, subj)
-    else:
-        print(f"Root CA already exists at {ROOT_CA_CRT}")
+    # Client cert
+    client_key = CLIENT_DIR / f"{team}-client.key"
+    client_crt = CLIENT_DIR / f"{team}-client.crt"
+
+    if not issue_cert(client_key, client_crt, subj, idx, force,
+                      shared_key=SHARED_CLIENT_KEY, use_shared_key=SHARED_KEYS):
+        logger.info("Client cert already exists at %s", client_crt)
 
-    for idx, (team, cfg) in enumerate(TEAMS.items(), start=1):
-        print(f"\n\033[94m----- Generating certs for {team} -----\033[0m")
-        cn = cfg["commonName"]
+    # Server cert
+    server_extensions = load_extensions(EXTFILE_VALID) if EXTFILE_VALID else ()
+    server_key = SERVER_DIR / f"{team}-server.key"
+    server_crt = SERVER_DIR / f"{team}-server.crt"
 
-        # Client cert
-        client_key = CLIENT_DIR / f"{team}-client.key"
-        client_csr = CLIENT_DIR / f"{team}-client.csr"
-        client_crt = CLIENT_DIR / f"{team}-client.crt"
+    if not issue_cert(server_key, server_crt, subj, idx, force,
+                      shared_key=SHARED_SERVER_KEY, use_shared_key=SHARED_KEYS, extensions=server_extensions):
+        logger.info("Server cert already exists at %s", server_crt)
 
-        generate_private_key(client_key)
-        subj = format_subj(DN_COMMON, ou=team, cn=cn)
-        create_csr(client_key, client_csr, subj)
-        sign_csr(client_csr, ROOT_CA_CRT, ROOT_CA_KEY, client_crt, serial=idx)
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Generate the Miniconomy root CA and per-team mTLS certificates.")
+    parser.add_argument("--force", action="store_true", help="regenerate all keys and certs, even if they already exist")
+    parser.add_argument("--quiet", action="store_true", help="don't log each key and cert as it is written")
+    args = parser.parse_args()
+
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO if args.quiet else logging.DEBUG)
+
+    for d in (CLIENT_DIR, SERVER_DIR, ZIPS_DIR):
+        d.mkdir(parents=True, exist_ok=True)
+
+    # Root CA generation
+    if args.force or not ROOT_CA_KEY.exists():
+        subj = format_subj(ou="RootCA", cn="RootCA")
+        create_self_signed_ca(ROOT_CA_KEY, ROOT_CA_CRT, subj, new_key=True)
+    else:
+        logger.info("Root CA already exists at %s", ROOT_CA_CRT)
 
-        # Server cert
-        server_key = SERVER_DIR / f"{team}-server.key"
-        server_csr = SERVER_DIR / f"{team}-server.csr"
-        server_crt = SERVER_DIR / f"{team}-server.crt"
+    if SHARED_KEYS:
+        for shared_key in (SHARED_CLIENT_KEY, SHARED_SERVER_KEY):
+            if args.force or not shared_key.exists():
+                generate_private_key(shared_key)
 
-        generate_private_key(server_key)
-        subj_srv = format_subj(DN_COMMON, ou=team, cn=cn)
-        create_csr(server_key, server_csr, subj_srv)
-        sign_csr(server_csr, ROOT_CA_CRT, ROOT_CA_KEY, server_crt, serial=idx, extfile=EXTFILE)
+    # Teams are independent once the root CA exists, so build them on a thread pool;
+    # a failure surfaces here once the other teams have finished
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+        list(ex.map(partial(generate_team, force=args.force), TEAMS.keys(), TEAMS.values(), range(1, len(TEAMS) + 1)))
 
-    print("\n\033[92mAll certificates generated successfully.\033[0m")
+    logger.info("All certificates generated successfully.")
     create_zips()
-    print("\nAll team bundles zipped in:", ZIPS_DIR)
+    logger.info("All team bundles zipped in: %s", ZIPS_DIR)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -13,6 +13,7 @@
           buildInputs= with pkgs; [
             openssl
             certbot
+            (python3.withPackages (ps: [ ps.cryptography ]))
           ];
         };
       }